@@ -0,0 +1,38 @@
+"""
+JSONL 파일 스캔용 저수준 헬퍼입니다.
+캐시 없이 파일 내용만 다루며, 타입이 모두 명시되어 있어 mypyc로 그대로 컴파일할 수 있습니다.
+(backend 디렉토리에서 `mypyc _fastio.py` 실행 시 생성된 확장 모듈이 이 파일 대신 import됩니다.)
+"""
+import mmap
+from typing import List
+
+WHITESPACE = b" \t\n\r\x0b\x0c"
+
+
+def index_jsonl(path: str) -> List[int]:
+    """파일 내 비어있지 않은 각 라인의 시작 바이트 오프셋 목록을 반환합니다."""
+    offsets: List[int] = []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            pos = 0
+            while pos < size:
+                end = mm.find(b"\n", pos)
+                if end == -1:
+                    end = size
+                # 첫 바이트가 공백이 아니면 라인 전체를 복사하지 않고 바로 판단
+                if end > pos and (mm[pos] not in WHITESPACE or mm[pos:end].strip()):
+                    offsets.append(pos)
+                pos = end + 1
+    return offsets
+
+
+def read_session_line(path: str, start: int) -> bytes:
+    """
+    start 오프셋에서 시작하는 한 라인을 mmap에서 잘라 bytes로 반환합니다.
+    파일 전체를 읽거나 디코딩하지 않고 해당 라인만 복사합니다.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = mm.find(b"\n", start)
+            return mm[start:end] if end != -1 else mm[start:]
@@ -1,14 +1,58 @@
-import json
+import gzip
+import logging
 import os
 import shutil
-from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+import stat
+from itertools import zip_longest
+
+import aiofiles
+import aiofiles.os
+import anyio.to_thread
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import List, Optional, Tuple
+
+from _fastio import read_session_line
+from services import (
+    BASE_PATH,
+    UPLOAD_DIRECTORY,
+    build_file_tree,
+    forget_cached_path,
+    get_cached_sessions,
+    get_safe_path,
+    get_session_offsets,
+    get_tree_etag,
+    lookup_session_offsets,
+    resolve_safe_path,
+    store_cached_session,
+)
+
+try:
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:
+    # 이전 버전의 python-multipart는 'multipart' 패키지명을 사용
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+# --- 응답 클래스 ---
+class OrjsonResponse(JSONResponse):
+    """표준 json 대신 orjson으로 응답 본문을 직렬화합니다."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
 # --- 설정 ---
-app = FastAPI()
-UPLOAD_DIRECTORY = "log/uploads"
+app = FastAPI(default_response_class=OrjsonResponse)
+UPLOAD_WRITE_BUFFER_SIZE = 1024 * 1024
+LARGE_PARSE_BYTES = 1024 * 1024
+GZIP_MIN_SIZE = 500
+GZIP_LEVEL = 6
 
 # --- CORS 설정 ---
 # 모든 origin 허용 (개발 환경용)
@@ -28,203 +72,341 @@ def on_startup():
     """애플리케이션 시작 시 업로드 디렉토리가 없으면 생성합니다."""
     os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 
-# --- 보안 헬퍼 함수 ---
-def get_safe_path(file_path: str) -> Path:
+# --- API 엔드포인트 ---
+
+class StreamingUploadParser:
     """
-    사용자로부터 받은 파일 경로를 검증하고 안전한 Path 객체로 반환합니다.
-    디렉토리 순회 공격을 방지합니다.
+    multipart/form-data 요청 본문을 조각 단위로 파싱합니다.
+    UploadFile처럼 파일 파트를 임시 파일에 모아두지 않고, 파싱 결과를
+    ("begin", 파일명) / ("data", bytes) / ("end", None) 이벤트로 돌려주어
+    호출하는 쪽에서 목적지 파일에 바로 기록할 수 있도록 합니다.
     """
-    base_path = Path(UPLOAD_DIRECTORY).resolve()
-    requested_path = Path(os.path.join(UPLOAD_DIRECTORY, file_path)).resolve()
 
-    if not requested_path.is_relative_to(base_path):
-        raise HTTPException(status_code=400, detail="안전하지 않은 파일 경로입니다.")
-    
-    return requested_path
+    def __init__(self, boundary: bytes):
+        self._header_field = b""
+        self._header_value = b""
+        self._content_disposition = b""
+        self._events: List[Tuple[str, Optional[object]]] = []
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+
+    def on_part_begin(self):
+        self._content_disposition = b""
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self._events.append(("data", data[start:end]))
+
+    def on_part_end(self):
+        self._events.append(("end", None))
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._content_disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._content_disposition)
+        filename = options.get(b"filename")
+        # 파일이 아닌 일반 폼 필드는 파일명을 None으로 전달
+        self._events.append(("begin", filename.decode("utf-8") if filename is not None else None))
+
+    def write(self, chunk: bytes) -> List[Tuple[str, Optional[object]]]:
+        """요청 본문 조각을 파싱하고, 그동안 발생한 이벤트 목록을 반환합니다."""
+        self._parser.write(chunk)
+        events, self._events = self._events, []
+        return events
+
+    def finalize(self):
+        self._parser.finalize()
 
-# --- API 엔드포인트 ---
 
 @app.post("/api/upload")
-async def upload_files(files: List[UploadFile] = File(...)):
+async def upload_files(request: Request):
     """
     프론트엔드에서 전송된 파일들을 받아 서버에 저장합니다.
+    요청 본문을 스트림으로 읽으면서 각 파일을 목적지 경로에 바로 기록합니다.
     """
-    for file in files:
-        if '..' in file.filename:
-            raise HTTPException(status_code=400, detail=f"잘못된 파일명입니다: {file.filename}")
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="multipart/form-data 형식의 요청이 아닙니다.")
 
-        save_path = Path(UPLOAD_DIRECTORY) / file.filename
-        save_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(save_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-    return {"message": f"{len(files)}개의 파일이 성공적으로 업로드되었습니다."}
+    upload_parser = StreamingUploadParser(params[b"boundary"])
+    saved_count = 0
+    save_path = None
+    out_file = None
+    # 작은 청크마다 쓰지 않고 일정 크기만큼 모아서 기록
+    pending = bytearray()
 
+    try:
+        async for chunk in request.stream():
+            for kind, value in upload_parser.write(chunk):
+                if kind == "begin":
+                    if value is None:
+                        continue
+                    if not value or '..' in value:
+                        raise HTTPException(status_code=400, detail=f"잘못된 파일명입니다: {value}")
+
+                    save_path = resolve_safe_path(value)
+                    # '.'처럼 업로드 디렉토리 자체나 기존 폴더를 가리키는 파일명은 파일로 쓸 수 없음
+                    if save_path == BASE_PATH or os.path.isdir(save_path):
+                        raise HTTPException(status_code=400, detail=f"잘못된 파일명입니다: {value}")
+                    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                    out_file = await aiofiles.open(save_path, "wb")
+                elif kind == "data":
+                    if out_file is not None:
+                        pending += value
+                        if len(pending) >= UPLOAD_WRITE_BUFFER_SIZE:
+                            await out_file.write(pending)
+                            pending.clear()
+                elif out_file is not None:
+                    if pending:
+                        await out_file.write(pending)
+                        pending.clear()
+                    await out_file.close()
+                    out_file = None
+                    saved_count += 1
+        upload_parser.finalize()
+    except FormParserError:
+        raise HTTPException(status_code=400, detail="잘못된 multipart 요청입니다.")
+    except UnicodeDecodeError:
+        # 파트 헤더의 파일명이 UTF-8이 아닌 경우
+        raise HTTPException(status_code=400, detail="파일명은 UTF-8로 인코딩되어야 합니다.")
+    finally:
+        # 중간에 실패한 경우 쓰다 만 파일은 남기지 않음
+        if out_file is not None:
+            await out_file.close()
+            if os.path.exists(save_path):
+                os.remove(save_path)
+        # 일부 파일만 저장된 경우에도 경로 캐시가 남지 않도록 항상 비움
+        resolve_safe_path.cache_clear()
+
+    if saved_count == 0:
+        raise HTTPException(status_code=400, detail="업로드할 파일이 없습니다.")
+
+    return {"message": f"{saved_count}개의 파일이 성공적으로 업로드되었습니다."}
 
-def build_file_tree(directory: str):
-    """
-    지정된 디렉토리의 파일 구조를 재귀적으로 탐색하여 트리 형태의 객체로 만듭니다.
-    .jsonl 파일의 경우, 내부를 읽어 각 라인을 대화 세션으로 하는 하위 노드를 생성합니다.
-    """
-    tree = []
-    base_path = Path(directory)
-
-    for item in sorted(base_path.iterdir()):
-        if item.name.startswith('.'):
-            continue
-
-        rel_path = item.relative_to(UPLOAD_DIRECTORY).as_posix()
-        node = {
-            "id": rel_path,
-            "name": item.name,
-            "path": rel_path,
-        }
-        if item.is_dir():
-            node["type"] = "folder"
-            node["children"] = build_file_tree(str(item))
-            if node["children"]:
-                tree.append(node)
-        elif item.name.endswith('.jsonl'):
-            node["type"] = "file"
-            sessions = []
-            try:
-                with open(item, "r", encoding="utf-8") as f:
-                    for i, line in enumerate(f):
-                        if line.strip():
-                            sessions.append({
-                                "id": f"{rel_path}:{i}",
-                                "name": f"Conv {i + 1}",
-                                "type": "session",
-                                "path": rel_path,
-                                "sessionIndex": i
-                            })
-            except Exception:
-                # 파일 읽기 실패 시 세션 목록은 비워둠
-                pass
-            
-            node["children"] = sessions
-            tree.append(node)
-            
-    return tree
 
 @app.get("/api/files")
-def get_files():
+def get_files(request: Request):
     """
     업로드된 파일 및 폴더의 전체 트리 구조를 반환합니다.
+    트리가 바뀌지 않았으면 (If-None-Match 일치) 304 응답으로 트리 생성을 건너뜁니다.
     """
     if not os.path.exists(UPLOAD_DIRECTORY):
-        return []
-    return build_file_tree(UPLOAD_DIRECTORY)
+        return OrjsonResponse([])
 
+    etag = get_tree_etag(BASE_PATH)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # 세션 인덱스 캐시를 세션 조회와 공유하도록 절대 경로 기준으로 탐색
+    # 트리는 가장 큰 응답이므로 응답 객체를 직접 반환하여 jsonable_encoder 변환을 건너뜀
+    return OrjsonResponse(build_file_tree(BASE_PATH), headers={"ETag": etag})
+
+
+_MISSING = object()
+
+def interleave_turns(user_turns: list, assistant_turns: list) -> list:
+    """
+    사용자 턴과 어시스턴트 턴을 번갈아 배치한 대화 목록을 만듭니다.
+    사용자 턴이 dict이면 그대로 사용하고, 아니면 user 메시지로 감쌉니다.
+    """
+    conversation = [None] * (len(user_turns) + len(assistant_turns))
+    idx = 0
+    # 턴 형식 판단을 루프 밖으로 빼서 형식별 루프를 따로 둠
+    if len(user_turns) > 0 and isinstance(user_turns[0], dict):
+        for user, assistant in zip_longest(user_turns, assistant_turns, fillvalue=_MISSING):
+            if user is not _MISSING:
+                conversation[idx] = user
+                idx += 1
+            if assistant is not _MISSING:
+                conversation[idx] = {'role': 'assistant', 'content': assistant}
+                idx += 1
+    else:
+        for user, assistant in zip_longest(user_turns, assistant_turns, fillvalue=_MISSING):
+            if user is not _MISSING:
+                conversation[idx] = {'role': 'user', 'content': user}
+                idx += 1
+            if assistant is not _MISSING:
+                conversation[idx] = {'role': 'assistant', 'content': assistant}
+                idx += 1
+    return conversation
+
+
+def build_accumulated_conversations(session_data: dict):
+    """
+    세션 데이터에 'accumulated_conversations'가 없으면 다른 키를 조합하여 생성합니다.
+    세션 데이터를 직접 수정합니다.
+    """
+    # 프론트엔드는 'accumulated_conversations'를 사용하므로, 이 키를 기준으로 데이터를 구성합니다.
+
+    # 1. 'accumulated_conversations'가 없는 경우, 다른 키에서 생성 시도
+    if 'accumulated_conversations' not in session_data:
+        conversation_to_process = None
+        # 1a. 'input'과 'response'를 조합 (우선순위 1)
+        if 'input' in session_data and 'response' in session_data:
+            conversation_to_process = interleave_turns(session_data['input'], session_data['response'])
+        # 1b. 'conversation'과 'response'를 조합 (우선순위 2)
+        elif 'conversation' in session_data and 'response' in session_data:
+            conversation_to_process = interleave_turns(session_data['conversation'], session_data['response'])
+        # 1c. 'conversation'만 있는 경우
+        elif 'conversation' in session_data:
+            conversation_to_process = session_data['conversation']
+
+        if conversation_to_process:
+            session_data['accumulated_conversations'] = conversation_to_process
+
+    # 2. 'accumulated_conversations'가 있으면, 내부 content의 개행문자 처리 -> 현재 비활성화
+    # if 'accumulated_conversations' in session_data:
+    #     for message in session_data['accumulated_conversations']:
+    #         if 'content' in message and isinstance(message['content'], str):
+    #             message['content'] = message['content'].replace('\n', '\n')
+
+
+def accepts_gzip(request: Request) -> bool:
+    """Accept-Encoding 헤더의 q 값을 확인하여 클라이언트가 gzip 응답을 받을 수 있는지 판단합니다."""
+    gzip_q = None
+    any_q = None
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ("gzip", "x-gzip"):
+            gzip_q = q
+        elif coding == "*":
+            any_q = q
+    # gzip이 명시되지 않았으면 '*'의 q 값을 따름
+    if gzip_q is None:
+        gzip_q = any_q if any_q is not None else 0.0
+    return gzip_q > 0
+
+def gzip_etag(etag: str) -> str:
+    """압축본은 원본과 다른 표현이므로 별도의 강한 ETag를 사용합니다. (RFC 9110 8.8.3)"""
+    return f'{etag[:-1]}-gz"'
+
+def make_session_response(request: Request, etag: str, content: bytes, gzipped: Optional[bytes]) -> Response:
+    """클라이언트가 gzip을 지원하고 압축본이 있으면 압축본으로, 아니면 원본으로 응답을 만듭니다."""
+    if gzipped is not None and accepts_gzip(request):
+        headers = {"ETag": gzip_etag(etag), "Vary": "Accept-Encoding", "Content-Encoding": "gzip"}
+        return Response(content=gzipped, headers=headers, media_type="application/json")
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    return Response(content=content, headers=headers, media_type="application/json")
+
+async def compress_session(request: Request, content: bytes) -> Optional[bytes]:
+    """gzip을 지원하는 클라이언트이고 응답이 충분히 크면 gzip 압축본을 만듭니다."""
+    if len(content) < GZIP_MIN_SIZE or not accepts_gzip(request):
+        return None
+    if len(content) >= LARGE_PARSE_BYTES:
+        return await run_in_threadpool(gzip.compress, content, GZIP_LEVEL)
+    return gzip.compress(content, GZIP_LEVEL)
 
 @app.get("/api/logs/{file_path:path}")
-def get_log_content(file_path: str, session: int = Query(0, description="파일 내 대화 세션의 인덱스")):
+async def get_log_content(request: Request, file_path: str, session: int = Query(0, description="파일 내 대화 세션의 인덱스")):
     """
     지정된 .jsonl 파일의 특정 세션(라인)에 해당하는 전체 JSON 객체를 반환합니다.
+    가공된 결과와 gzip 압축본을 캐시하며, ETag가 일치하면 304 응답을 반환합니다.
     """
-    safe_path = get_safe_path(file_path)
+    safe_path, st = get_safe_path(file_path)
 
-    if not safe_path.is_file():
+    if st is None or not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404, detail="파일을 찾을 수 없습니다.")
 
+    # 파일이 바뀌지 않았다면 같은 세션의 응답도 같으므로 mtime/size/세션 인덱스로 ETag 생성
+    etag = f'"{st.st_mtime_ns}-{st.st_size}-{session}"'
+    # 원본과 압축본 중 클라이언트가 가진 표현의 ETag와 일치하면 304 응답
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag in (etag, gzip_etag(etag)):
+                return Response(status_code=304, headers={"ETag": tag, "Vary": "Accept-Encoding"})
+
     try:
-        with open(safe_path, "r", encoding="utf-8") as f:
-            lines = [line for line in f if line.strip()]
-        
-        if session >= len(lines):
+        offsets = lookup_session_offsets(safe_path, st)
+        if offsets is None:
+            offsets = await run_in_threadpool(get_session_offsets, safe_path, st)
+
+        if session >= len(offsets):
             raise HTTPException(status_code=404, detail="세션을 찾을 수 없습니다.")
 
+        # 이미 가공 및 직렬화된 세션이 있으면 그대로 반환 (필요하면 압축본만 추가로 생성)
+        sessions = get_cached_sessions(safe_path, st)
+        if session in sessions:
+            content, gzipped = sessions[session]
+            if gzipped is None:
+                gzipped = await compress_session(request, content)
+                if gzipped is not None:
+                    store_cached_session(safe_path, st, session, content, gzipped)
+            return make_session_response(request, etag, content, gzipped)
+
+        # 파일 전체를 읽지 않고 요청한 세션의 라인만 읽음
+        line = await run_in_threadpool(read_session_line, safe_path, offsets[session])
+
         try:
-            session_data = json.loads(lines[session])
-        except json.JSONDecodeError as e:
-            print(f"--- !!! [Session {session}] JSONDecodeError !!! ---")
-            print(f"Error: {e}")
-            print("--- Failing line content: ---")
-            print(lines[session])
+            # 큰 세션은 이벤트 루프를 막지 않도록 스레드풀에서 파싱
+            if len(line) >= LARGE_PARSE_BYTES:
+                session_data = await run_in_threadpool(orjson.loads, line)
+            else:
+                session_data = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # 세션 라인이 매우 클 수 있으므로 앞부분만 기록
+            logger.exception(
+                "[Session %d] JSONDecodeError in %s: %.200s",
+                session, file_path, line.decode("utf-8", errors="replace"),
+            )
             raise HTTPException(status_code=500, detail=f"로그 파일의 JSON 형식이 잘못되었습니다: line {session}")
 
-        # print(session_data)
-        
-        # 프론트엔드는 'accumulated_conversations'를 사용하므로, 이 키를 기준으로 데이터를 구성합니다.
-        
-        # 1. 'accumulated_conversations'가 없는 경우, 다른 키에서 생성 시도
-        if 'accumulated_conversations' not in session_data:
-            print(f"--- [Session {session}] 'accumulated_conversations' not found. Attempting to construct it. ---")
-            conversation_to_process = None
-            # 1a. 'input'과 'response'를 조합 (우선순위 1)
-            if 'input' in session_data and 'response' in session_data:
-                print(f"--- [Session {session}] Constructing from 'input' and 'response'. ---")
-                new_conversation = []
-                input_turns = session_data['input']
-                assistant_turns = session_data['response']
-                is_input_turn_object = len(input_turns) > 0 and isinstance(input_turns[0], dict)
-                max_len = max(len(input_turns), len(assistant_turns))
-                for i in range(max_len):
-                    if i < len(input_turns):
-                        if is_input_turn_object:
-                            new_conversation.append(input_turns[i])
-                        else:
-                            new_conversation.append({'role': 'user', 'content': input_turns[i]})
-                    if i < len(assistant_turns):
-                        new_conversation.append({'role': 'assistant', 'content': assistant_turns[i]})
-                conversation_to_process = new_conversation
-            # 1b. 'conversation'과 'response'를 조합 (우선순위 2)
-            elif 'conversation' in session_data and 'response' in session_data:
-                print(f"--- [Session {session}] Constructing from 'conversation' and 'response'. ---")
-                new_conversation = []
-                user_turns = session_data['conversation']
-                assistant_turns = session_data['response']
-                is_user_turn_object = len(user_turns) > 0 and isinstance(user_turns[0], dict)
-                max_len = max(len(user_turns), len(assistant_turns))
-                for i in range(max_len):
-                    if i < len(user_turns):
-                        if is_user_turn_object:
-                            new_conversation.append(user_turns[i])
-                        else:
-                            new_conversation.append({'role': 'user', 'content': user_turns[i]})
-                    if i < len(assistant_turns):
-                        new_conversation.append({'role': 'assistant', 'content': assistant_turns[i]})
-                conversation_to_process = new_conversation
-            # 1c. 'conversation'만 있는 경우
-            elif 'conversation' in session_data:
-                print(f"--- [Session {session}] Constructing from 'conversation' only. ---")
-                conversation_to_process = session_data['conversation']
-            
-            if conversation_to_process:
-                session_data['accumulated_conversations'] = conversation_to_process
-                print(f"--- [Session {session}] Constructed 'accumulated_conversations'. ---")
-                # print(session_data['accumulated_conversations'])
-
-        # 2. 'accumulated_conversations'가 있으면, 내부 content의 개행문자 처리 -> 현재 비활성화
-        # if 'accumulated_conversations' in session_data:
-        #     for message in session_data['accumulated_conversations']:
-        #         if 'content' in message and isinstance(message['content'], str):
-        #             message['content'] = message['content'].replace('\n', '\n')
-
-        # print(session_data)
-        return session_data
-
-    except json.JSONDecodeError:
+        build_accumulated_conversations(session_data)
+        content = orjson.dumps(session_data)
+        gzipped = await compress_session(request, content)
+        store_cached_session(safe_path, st, session, content, gzipped)
+
+        return make_session_response(request, etag, content, gzipped)
+
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=500, detail="로그 파일의 형식이 잘못되었습니다.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"파일을 읽는 중 오류 발생: {e}")
 
 @app.delete("/api/files/{file_path:path}")
-def delete_file_or_folder(file_path: str):
+async def delete_file_or_folder(file_path: str):
     """
     지정된 파일 또는 폴더를 서버에서 삭제합니다.
     """
-    safe_path = get_safe_path(file_path)
+    safe_path, st = get_safe_path(file_path)
 
     try:
-        if safe_path.is_file():
-            os.remove(safe_path)
-        elif safe_path.is_dir():
-            shutil.rmtree(safe_path)
+        if st is not None and stat.S_ISREG(st.st_mode):
+            await aiofiles.os.remove(safe_path)
+        elif st is not None and stat.S_ISDIR(st.st_mode):
+            await anyio.to_thread.run_sync(shutil.rmtree, safe_path)
         else:
             raise HTTPException(status_code=404, detail="삭제할 파일이나 폴더를 찾을 수 없습니다.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"삭제 중 오류 발생: {e}")
+    finally:
+        resolve_safe_path.cache_clear()
+        forget_cached_path(safe_path)
 
     return {"message": f"'{file_path}'가 성공적으로 삭제되었습니다."}
@@ -0,0 +1,319 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from _fastio import index_jsonl
+
+# --- 설정 ---
+UPLOAD_DIRECTORY = "log/uploads"
+TREE_SCAN_WORKERS = 8
+
+# --- 보안 헬퍼 함수 ---
+# 업로드 디렉토리의 절대 경로는 시작 시 한 번만 계산
+BASE_PATH = os.path.abspath(UPLOAD_DIRECTORY)
+BASE_REAL_PATH = os.path.realpath(BASE_PATH)
+
+@lru_cache(maxsize=1024)
+def resolve_safe_path(file_path: str) -> str:
+    """
+    사용자로부터 받은 파일 경로를 검증하고 안전한 절대 경로 문자열로 반환합니다.
+    디렉토리 순회 공격과 업로드 디렉토리 밖을 가리키는 심볼릭 링크를 통한 접근을 방지합니다.
+    결과는 경로 문자열별로 캐시되며, 파일이 추가/삭제되면 cache_clear()로 비웁니다.
+    """
+    # Path 객체를 만들지 않고 os.path 문자열 연산만으로 정규화 및 검증
+    candidate = os.path.abspath(os.path.join(BASE_PATH, file_path))
+
+    if candidate != BASE_PATH and not candidate.startswith(BASE_PATH + os.sep):
+        raise HTTPException(status_code=400, detail="안전하지 않은 파일 경로입니다.")
+
+    # abspath는 심볼릭 링크를 따라가지 않으므로 실제 경로로 한 번 더 검증
+    real_path = os.path.realpath(candidate)
+    if real_path != BASE_REAL_PATH and not real_path.startswith(BASE_REAL_PATH + os.sep):
+        raise HTTPException(status_code=400, detail="안전하지 않은 파일 경로입니다.")
+
+    # 캐시 키가 일관되도록 반환값은 심볼릭 링크를 풀지 않은 경로를 유지
+    return candidate
+
+def get_safe_path(file_path: str) -> Tuple[str, Optional[os.stat_result]]:
+    """
+    resolve_safe_path로 검증한 경로와 그 stat 결과를 함께 반환합니다.
+    호출하는 쪽은 이 stat 결과로 파일/디렉토리 여부를 판단하여 추가 stat 호출을 하지 않습니다.
+    경로가 존재하지 않으면 stat 결과는 None입니다.
+    """
+    safe_path = resolve_safe_path(file_path)
+    try:
+        st = os.stat(safe_path)
+    except OSError:
+        st = None
+    return safe_path, st
+
+# --- 로그 파싱 캐시 ---
+# 파일 경로별로 (mtime_ns, size, {세션 인덱스: (직렬화된 세션 JSON, gzip 압축본)})을 보관합니다.
+# 같은 세션을 다시 요청할 때 파일을 다시 읽고 파싱/직렬화/압축하지 않도록 합니다.
+# gzip 압축본은 gzip을 지원하는 클라이언트가 처음 요청할 때 만들어지며, 그 전에는 None입니다.
+# 메모리 한도는 원본 파일 크기가 아니라 실제로 캐시에 저장된 바이트 수 기준입니다.
+LOG_CACHE_MAX_FILES = 32
+LOG_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+_log_cache: "OrderedDict[str, Tuple[int, int, Dict[int, Tuple[bytes, Optional[bytes]]]]]" = OrderedDict()
+# 경로별로 캐시된 세션들의 직렬화본 + 압축본 바이트 합계
+_log_cache_bytes: Dict[str, int] = {}
+_log_cache_lock = threading.Lock()
+
+def _cached_size(cached: Tuple[bytes, Optional[bytes]]) -> int:
+    return len(cached[0]) + len(cached[1] or b"")
+
+def get_cached_sessions(path: str, st: os.stat_result) -> Dict[int, Tuple[bytes, Optional[bytes]]]:
+    """
+    파일의 세션별 직렬화 결과를 담는 딕셔너리를 반환합니다. 읽기 전용으로 사용하며,
+    저장은 store_cached_session으로 합니다.
+    캐시가 없거나 파일의 mtime 또는 크기가 바뀌었으면 빈 딕셔너리를 반환합니다.
+    """
+    with _log_cache_lock:
+        entry = _log_cache.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            _log_cache.move_to_end(path)
+            return entry[2]
+    return {}
+
+def store_cached_session(path: str, st: os.stat_result, session: int, content: bytes, gzipped: Optional[bytes]):
+    """
+    세션의 직렬화 결과를 캐시에 저장하고, 한도를 넘으면 오래된 파일부터 제거합니다.
+    가장 최근 파일 하나만으로도 한도를 넘는 경우에는 이 세션을 저장하지 않습니다.
+    """
+    cached = (content, gzipped)
+    with _log_cache_lock:
+        entry = _log_cache.get(path)
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            entry = (st.st_mtime_ns, st.st_size, {})
+            _log_cache[path] = entry
+            _log_cache_bytes[path] = 0
+        _log_cache.move_to_end(path)
+
+        sessions = entry[2]
+        previous = sessions.get(session)
+        if previous is not None:
+            _log_cache_bytes[path] -= _cached_size(previous)
+        sessions[session] = cached
+        _log_cache_bytes[path] += _cached_size(cached)
+
+        # 오래된 항목부터 제거 (가장 최근 항목은 항상 유지)
+        total_bytes = sum(_log_cache_bytes.values())
+        while len(_log_cache) > 1 and (len(_log_cache) > LOG_CACHE_MAX_FILES or total_bytes > LOG_CACHE_MAX_BYTES):
+            evicted_path, _ = _log_cache.popitem(last=False)
+            total_bytes -= _log_cache_bytes.pop(evicted_path)
+
+        if total_bytes > LOG_CACHE_MAX_BYTES:
+            del sessions[session]
+            _log_cache_bytes[path] -= _cached_size(cached)
+
+# --- 세션 인덱스 캐시 ---
+# .jsonl 파일 경로별로 (mtime_ns, size, 비어있지 않은 라인의 시작 오프셋 목록)을 보관합니다.
+# 파일 트리 요청과 세션 조회 시 파일 전체를 다시 읽지 않도록 합니다.
+# 파일 트리 요청은 모든 .jsonl 파일을 인덱싱하므로 파일 수 한도는 넉넉하게 두고,
+# 메모리는 캐시된 오프셋 개수 합계로 제한합니다.
+SESSION_INDEX_CACHE_MAX_FILES = 4096
+SESSION_INDEX_CACHE_MAX_OFFSETS = 2 * 1024 * 1024
+
+_session_index_cache: "OrderedDict[str, Tuple[int, int, List[int]]]" = OrderedDict()
+_session_index_offsets = 0
+# 파일 트리 스캔 스레드들이 동시에 저장하므로 잠금으로 보호
+_session_index_lock = threading.Lock()
+
+def lookup_session_offsets(path: str, st: os.stat_result) -> Optional[List[int]]:
+    """캐시된 세션 오프셋 목록이 유효하면 반환하고, 없거나 오래되었으면 None을 반환합니다."""
+    with _session_index_lock:
+        entry = _session_index_cache.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            _session_index_cache.move_to_end(path)
+            return entry[2]
+    return None
+
+def get_session_offsets(path: str, st: os.stat_result) -> List[int]:
+    """
+    파일 내 각 세션(비어있지 않은 라인)의 시작 바이트 오프셋 목록을 반환합니다.
+    파일의 mtime 또는 크기가 바뀐 경우에만 파일을 다시 스캔합니다.
+    """
+    global _session_index_offsets
+
+    offsets = lookup_session_offsets(path, st)
+    if offsets is not None:
+        return offsets
+
+    # 빈 파일은 mmap할 수 없으므로 바로 처리
+    offsets = index_jsonl(path) if st.st_size > 0 else []
+
+    with _session_index_lock:
+        previous = _session_index_cache.pop(path, None)
+        if previous is not None:
+            _session_index_offsets -= len(previous[2])
+        _session_index_cache[path] = (st.st_mtime_ns, st.st_size, offsets)
+        _session_index_offsets += len(offsets)
+
+        # 오래된 항목부터 제거 (가장 최근 항목은 항상 유지)
+        while len(_session_index_cache) > 1 and (
+            len(_session_index_cache) > SESSION_INDEX_CACHE_MAX_FILES
+            or _session_index_offsets > SESSION_INDEX_CACHE_MAX_OFFSETS
+        ):
+            _, evicted = _session_index_cache.popitem(last=False)
+            _session_index_offsets -= len(evicted[2])
+    return offsets
+
+def forget_cached_path(path: str):
+    """
+    삭제된 파일 또는 폴더 아래의 모든 경로를 로그 캐시와 세션 인덱스 캐시에서 제거합니다.
+    """
+    global _session_index_offsets
+
+    prefix = path + os.sep
+    with _session_index_lock:
+        for cached_path in [p for p in _session_index_cache if p == path or p.startswith(prefix)]:
+            _session_index_offsets -= len(_session_index_cache.pop(cached_path)[2])
+    with _log_cache_lock:
+        for cached_path in [p for p in _log_cache if p == path or p.startswith(prefix)]:
+            del _log_cache[cached_path]
+            _log_cache_bytes.pop(cached_path, None)
+
+# --- 파일 트리 ---
+def _is_empty_folder(node: dict) -> bool:
+    return node["type"] == "folder" and not node["children"]
+
+def collect_file_tree(directory: str, file_nodes: list):
+    """
+    지정된 디렉토리의 파일 구조를 명시적인 스택으로 탐색하여 트리 형태의 객체로 만듭니다.
+    .jsonl 파일은 내용을 읽지 않고 (노드, 경로, stat) 형태로 file_nodes에 모아둡니다.
+    os.scandir의 DirEntry 정보를 사용하여 항목마다 추가 stat 호출을 하지 않습니다.
+    """
+    tree = []
+    folders = []
+    # (탐색할 디렉토리 경로, 상대 경로 접두어, 하위 노드를 추가할 목록)
+    stack = [(directory, "", tree)]
+
+    while stack:
+        current_dir, rel_prefix, children = stack.pop()
+
+        try:
+            with os.scandir(current_dir) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            # 탐색 도중 삭제된 폴더는 빈 폴더로 취급 (마지막에 정리됨)
+            continue
+
+        for item in entries:
+            if item.name.startswith('.'):
+                continue
+
+            rel_path = f"{rel_prefix}{item.name}"
+            node = {
+                "id": rel_path,
+                "name": item.name,
+                "path": rel_path,
+            }
+            if item.is_dir(follow_symlinks=False):
+                node["type"] = "folder"
+                node["children"] = []
+                folders.append(node)
+                stack.append((item.path, f"{rel_path}/", node["children"]))
+                children.append(node)
+            elif item.name.endswith('.jsonl'):
+                node["type"] = "file"
+                node["children"] = []
+                try:
+                    file_nodes.append((node, item.path, item.stat()))
+                except OSError:
+                    # stat 실패 시 세션 목록은 비워둠
+                    pass
+                children.append(node)
+
+    # 빈 폴더 제거: 하위 폴더는 항상 상위 폴더보다 나중에 발견되므로 역순으로 정리
+    for folder in reversed(folders):
+        folder["children"] = [child for child in folder["children"] if not _is_empty_folder(child)]
+
+    return [node for node in tree if not _is_empty_folder(node)]
+
+def read_session_count(path: str, st: os.stat_result) -> int:
+    """파일 내 세션 수를 반환하며, 파일 읽기 실패 시 0을 반환합니다."""
+    try:
+        return len(get_session_offsets(path, st))
+    except Exception:
+        return 0
+
+def build_file_tree(directory: str):
+    """
+    지정된 디렉토리의 파일 구조를 트리 형태의 객체로 만듭니다.
+    .jsonl 파일의 경우, 각 라인을 대화 세션으로 하는 하위 노드를 생성합니다.
+    세션 인덱스가 캐시되지 않은 파일이 여럿이면 스레드풀에서 동시에 스캔합니다.
+    """
+    file_nodes = []
+    tree = collect_file_tree(directory, file_nodes)
+
+    # 세션 수는 파일마다 한 번만 구함 (캐시 한도를 넘는 트리에서는 캐시에 다시 의존할 수 없음)
+    counts: Dict[str, int] = {}
+    stale = []
+    for _, path, st in file_nodes:
+        offsets = lookup_session_offsets(path, st)
+        if offsets is None:
+            stale.append((path, st))
+        else:
+            counts[path] = len(offsets)
+
+    if len(stale) > 1:
+        with ThreadPoolExecutor(max_workers=min(TREE_SCAN_WORKERS, len(stale))) as executor:
+            counts.update(zip((path for path, _ in stale), executor.map(lambda args: read_session_count(*args), stale)))
+    else:
+        for path, st in stale:
+            counts[path] = read_session_count(path, st)
+
+    for node, path, _ in file_nodes:
+        rel_path = node["path"]
+        node["children"] = [
+            {
+                "id": f"{rel_path}:{i}",
+                "name": f"Conv {i + 1}",
+                "type": "session",
+                "path": rel_path,
+                "sessionIndex": i
+            }
+            for i in range(counts[path])
+        ]
+
+    return tree
+
+def get_tree_etag(directory: str) -> str:
+    """
+    디렉토리 트리의 항목 수, 가장 최근 mtime, 전체 파일 크기로 ETag 값을 만듭니다.
+    파일 내용을 읽지 않으므로 트리를 다시 만드는 것보다 훨씬 가볍습니다.
+    """
+    count = 0
+    total_size = 0
+    max_mtime = os.stat(directory).st_mtime_ns
+    stack = [directory]
+
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            # 스택에 넣은 뒤 삭제된 폴더는 건너뜀 (삭제는 상위 디렉토리 mtime에 반영됨)
+            continue
+        with it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # 깨진 심볼릭 링크나 탐색 도중 삭제된 항목은 ETag 계산에서 제외 (추가/삭제는 디렉토리 mtime에 반영됨)
+                    continue
+                count += 1
+                total_size += st.st_size
+                if st.st_mtime_ns > max_mtime:
+                    max_mtime = st.st_mtime_ns
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+    return f'"{count}-{max_mtime}-{total_size}"'